@@ -1,9 +1,13 @@
 import os
+import re
+import asyncio
+import bisect
+import random
+import threading
+import time
+import httpx
 import streamlit as st
 from dotenv import load_dotenv
-from openai import OpenAI
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
 
 # ======================================
 # 0. Load Environment Variables
@@ -17,56 +21,116 @@ DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 SPOTIFY_REDIRECT_URI = "https://playlistgenerator.streamlit.app"
+SPOTIFY_API_URL = "https://api.spotify.com/v1"
+SEARCH_CONCURRENCY = 8  # Safe concurrency under Spotify's per-app rate limit
+RATE_LIMIT_RETRIES = 3
+MAX_RETRY_AFTER = 30  # Seconds; longer Spotify back-offs fail the run instead of waiting
+PAGE_CONCURRENCY = 5
+PAGE_SIZE = 100  # Spotify's max page size for playlist tracks
+ADD_BATCH_SIZE = 100  # Spotify's max track URIs per add-tracks request
+COMPLETION_CACHE_TTL = 3600  # Seconds before an identical prompt asks the AI again
+COMPLETION_CACHE_SIZE = 32
+PROMPT_TRACK_LIMIT = 100  # Source tracks sent to the AI; larger playlists are sampled
 
-# Initialize APIs
-client = OpenAI(
-    api_key=DEEPSEEK_API_KEY,
-    base_url="https://api.deepseek.com/v1"
-)
-sp_oauth = SpotifyOAuth(
-    client_id=SPOTIFY_CLIENT_ID,
-    client_secret=SPOTIFY_CLIENT_SECRET,
-    redirect_uri=SPOTIFY_REDIRECT_URI,
-    scope="playlist-read-private playlist-modify-private playlist-modify-public"
-)
+# Initialize APIs lazily so cold starts don't pay for importing the SDKs.
+# Cached as resources so every session and rerun shares one connection pool.
+@st.cache_resource
+def get_openai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(
+        api_key=DEEPSEEK_API_KEY,
+        base_url="https://api.deepseek.com/v1",
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+        )
+    )
+
+@st.cache_resource
+def get_sp_oauth():
+    from spotipy.oauth2 import SpotifyOAuth
+    return SpotifyOAuth(
+        client_id=SPOTIFY_CLIENT_ID,
+        client_secret=SPOTIFY_CLIENT_SECRET,
+        redirect_uri=SPOTIFY_REDIRECT_URI,
+        scope="playlist-read-private playlist-modify-private playlist-modify-public"
+    )
+
+@st.cache_resource
+def _get_event_loop():
+    """Long-lived event loop shared by all sessions so pooled async clients stay usable."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource
+def _get_rate_limit_gate():
+    """Open while Spotify isn't rate limiting the app; shared by every run on the loop."""
+    gate = asyncio.Event()
+    gate.set()
+    return gate
+
+def submit_async(coro):
+    """Schedule a coroutine on the shared event loop, returning a concurrent Future."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop())
 
 # ======================================
 # 2. Enhanced UI Components
 # ======================================
+_LOGIN_CSS = """
+<style>
+    .login-btn {
+        background: linear-gradient(135deg, #1DB954 0%, #1ED760 100%);
+        color: white !important;
+        padding: 14px 32px;
+        border-radius: 30px;
+        border: none;
+        font-size: 18px;
+        font-weight: 600;
+        cursor: pointer;
+        transition: transform 0.2s;
+        box-shadow: 0 4px 6px rgba(0,0,0,0.1);
+        display: inline-block;
+        text-align: center;
+        width: fit-content;
+        margin: 2rem auto;
+    }
+    .login-btn:hover {
+        transform: translateY(-2px);
+        box-shadow: 0 6px 8px rgba(0,0,0,0.15);
+    }
+</style>
+"""
+
 def styled_login_button():
-    auth_url = sp_oauth.get_authorize_url()
+    auth_url = get_sp_oauth().get_authorize_url()
     st.markdown(
-        f"""
-        <style>
-            .login-btn {{
-                background: linear-gradient(135deg, #1DB954 0%, #1ED760 100%);
-                color: white !important;
-                padding: 14px 32px;
-                border-radius: 30px;
-                border: none;
-                font-size: 18px;
-                font-weight: 600;
-                cursor: pointer;
-                transition: transform 0.2s;
-                box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-                display: inline-block;
-                text-align: center;
-                width: fit-content;
-                margin: 2rem auto;
-            }}
-            .login-btn:hover {{
-                transform: translateY(-2px);
-                box-shadow: 0 6px 8px rgba(0,0,0,0.15);
-            }}
-        </style>
-        <a href="{auth_url}" class="login-btn">🎵 Connect with Spotify</a>
-        """,
+        _LOGIN_CSS + f'<a href="{auth_url}" class="login-btn">🎵 Connect with Spotify</a>',
         unsafe_allow_html=True
     )
 
 # ======================================
 # 3. Authentication Handling
 # ======================================
+def spotify_client(token):
+    """Spotify client with bounded timeouts and retries on a larger keep-alive pool."""
+    import spotipy
+    from requests.adapters import HTTPAdapter
+    sp = spotipy.Spotify(
+        auth=token,
+        requests_timeout=10,
+        retries=3,
+        status_retries=3,
+        backoff_factor=0.3
+    )
+    # Keep the retry policy spotipy configured on its default adapter
+    retry = sp._session.get_adapter("https://").max_retries
+    sp._session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=retry)
+    )
+    return sp
+
 def authenticate_spotify():
     """Handles authentication and session management."""
     if "sp" not in st.session_state or "auth_token" not in st.session_state:
@@ -74,16 +138,19 @@ def authenticate_spotify():
             try:
                 # Force fresh authentication
                 code = st.query_params["code"]
-                token_info = sp_oauth.get_access_token(code)
+                token_info = get_sp_oauth().get_access_token(code)
                 if isinstance(token_info, dict) and "access_token" in token_info:
                     access_token = token_info["access_token"]
                 else:
                     st.error("Failed to retrieve Spotify access token.")
                     return
                 
-                # Save to session state
-                st.session_state.sp = spotipy.Spotify(auth=token_info["access_token"])
-                st.session_state.auth_token = token_info["access_token"]
+                # Save to session state only once the profile lookup succeeds
+                sp = spotify_client(access_token)
+                user_id = sp.me()["id"]
+                st.session_state.sp = sp
+                st.session_state.auth_token = access_token
+                st.session_state.user_id = user_id
 
                 # Clear query parameters
                 del st.query_params["code"]
@@ -92,6 +159,11 @@ def authenticate_spotify():
                 st.error(f"Authentication failed: {str(e)}")
     return st.session_state.get("sp", None)
 
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_playlists(token: str):
+    """Current user's playlists, cached per token across reruns."""
+    return spotify_client(token).current_user_playlists()["items"]
+
 # ======================================
 # 4. Main App
 # ======================================
@@ -108,10 +180,15 @@ def main():
     with col2:
         if "sp" in st.session_state:
             if st.button("🔒 Switch Account", help="Log out and use a different Spotify account"):
-                # Clear session state and delete token cache
+                # Stop any running generation, clear session state and delete token cache
+                if "future" in st.session_state:
+                    st.session_state.future.cancel()
+                _cached_playlists.clear()
                 st.session_state.clear()
-                if os.path.exists(".cache"):
-                    os.remove(".cache")
+                try:
+                    os.unlink(get_sp_oauth().cache_handler.cache_path)
+                except FileNotFoundError:
+                    pass
                 st.rerun()
 
     # Authenticate Spotify
@@ -123,7 +200,7 @@ def main():
     # Playlist selection
     with st.expander("🎵 STEP 1: Choose Your Source Playlist", expanded=True):
         try:
-            playlists = sp.current_user_playlists()["items"]
+            playlists = _cached_playlists(st.session_state.auth_token)
             if not playlists:
                 st.warning("No playlists found in your account!")
                 return
@@ -164,124 +241,305 @@ def main():
             mood = st.slider("Sadder vs Happier", 0, 100, 50, 
                            help="Sadder or happier mood")
 
-    # Generate Playlist
-    if st.button("✨ Generate Playlist", use_container_width=True):
-        with st.spinner("🎶 Analyzing your music taste..."):
-            try:
-                # Get playlist tracks
-                tracks = sp.playlist_tracks(selected_playlist['id'])['items']
-                track_names = [t['track']['name'] for t in tracks if t['track']]
-
-                # Get AI Recommendations
-                recommendations = get_recommendations(
-                    track_names, 
-                    playlist_length,
-                    release_year,
-                    tempo,
-                    energy,
-                    mood
-                )
-
-                if not recommendations:
-                    st.error("Failed to generate recommendations")
-                    return
+    # Collect a finished run first so the button below is re-enabled on this rerun
+    finished = None
+    future = st.session_state.get("future")
+    if future is not None and future.done():
+        finished = st.session_state.pop("future")
+        future = None
 
-                # Create new playlist
-                with st.spinner("📀 Creating your Spotify playlist..."):
-                    playlist_url = create_spotify_playlist(sp, recommendations, playlist_name)
+    # Generate Playlist in the background so the page stays interactive
+    if st.button("✨ Generate Playlist", use_container_width=True, disabled=future is not None):
+        st.session_state.progress = {"resolved": 0, "total": playlist_length}
+        st.session_state.future = submit_async(_generate(
+            get_openai_client(),
+            _get_rate_limit_gate(),
+            st.session_state.auth_token,
+            st.session_state.user_id,
+            st.session_state.setdefault("id_cache", {}),
+            st.session_state.setdefault("completion_cache", {}),
+            st.session_state.progress,
+            selected_playlist,
+            playlist_length,
+            release_year,
+            tempo,
+            energy,
+            mood,
+            playlist_name
+        ))
+        st.rerun()
 
-                st.success(f"🎉 Playlist created successfully! [Open in Spotify]({playlist_url})")
-            except Exception as e:
-                st.error(f"Generation failed: {str(e)}")
+    if future is not None:
+        progress = st.session_state.progress
+        resolved = min(progress["resolved"], progress["total"])
+        st.progress(
+            resolved / progress["total"],
+            text=f"🎶 Analyzing your music taste... {resolved}/{progress['total']} tracks resolved"
+        )
+        if st.button("✖️ Cancel"):
+            future.cancel()
+        time.sleep(0.5)
+        st.rerun()
+
+    if finished is None:
+        return
+    if finished.cancelled():
+        st.warning("Generation cancelled")
+        return
+    try:
+        playlist_url = finished.result()
+        if playlist_url is None:
+            st.error("Failed to generate recommendations")
+            return
+
+        # Show the new playlist in STEP 1 from the next rerun on
+        _cached_playlists.clear()
+        st.success(f"🎉 Playlist created successfully! [Open in Spotify]({playlist_url})")
+    except Exception as e:
+        st.error(f"Generation failed: {str(e)}")
 
 # ======================================
 # 5. AI Recommendation Logic
 # ======================================
+_FEATURE_LABELS = (
+    ("releases", "older", "newer"),
+    ("tempo", "slower", "faster"),
+    ("energy", "softer", "harder"),
+    ("mood", "sadder", "happier")
+)
+_ADJ = ("slightly", "moderately", "significantly")
+_ADJ_CUTOFFS = (0.2, 0.5)  # Upper bound (inclusive) of each intensity tier
+
 def get_adjustment(value, feature_name, left_label, right_label):
     """Convert slider value to natural language adjustment"""
     if value == 50:
         return None
     direction = right_label if value > 50 else left_label
     intensity = abs(value - 50) / 50
-    
-    if intensity <= 0.2:
-        adj = "slightly"
-    elif intensity <= 0.5:
-        adj = "moderately"
-    else:
-        adj = "significantly"
-    
+    adj = _ADJ[bisect.bisect_left(_ADJ_CUTOFFS, intensity)]
     return f"{adj} {direction} {feature_name}"
 
-def get_recommendations(song_list, num_songs, release_year, tempo, energy, mood):
-    try:
-        # Generate adjustment descriptions
-        adjustments = []
-        features = [
-            (release_year, "releases", "older", "newer"),
-            (tempo, "tempo", "slower", "faster"),
-            (energy, "energy", "softer", "harder"),
-            (mood, "mood", "sadder", "happier")
-        ]
-        
-        for value, feature, left, right in features:
-            adjustment = get_adjustment(value, feature, left, right)
-            if adjustment:
-                adjustments.append(adjustment)
-
-        # Build dynamic prompt
-        prompt = f"""
-        Recommend {num_songs} songs most similar to these: {', '.join(song_list)}.
-        {"Match the songs listed above, but with these slight adjustments: " + ", ".join(adjustments) + "." if adjustments else ""}
-        Return only a numbered list with artist and title.
-        Format as: 1. Artist - Song Title
-        """
-
-        # Get AI response
-        response = client.chat.completions.create(
-            model="deepseek-reasoner",
-            messages=[
-                {"role": "system", "content": "You are a music recommendation expert."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7
-        )
+def _build_prompt(song_tuple, sampled_from, num_songs, release_year, tempo, energy, mood):
+    """Build the recommendation prompt."""
+    # Generate adjustment descriptions
+    adjustments = []
+    for value, (feature, left, right) in zip((release_year, tempo, energy, mood), _FEATURE_LABELS):
+        adjustment = get_adjustment(value, feature, left, right)
+        if adjustment:
+            adjustments.append(adjustment)
 
-        return parse_recommendations(response.choices[0].message.content)
-    except Exception as e:
-        st.error(f"Recommendation failed: {str(e)}")
-        return []
+    # Build dynamic prompt
+    if sampled_from:
+        source = f"these representative tracks from my playlist of {sampled_from}"
+    else:
+        source = "these"
+    return f"""
+    Recommend {num_songs} songs most similar to {source}: {', '.join(song_tuple)}.
+    {"Match the songs listed above, but with these slight adjustments: " + ", ".join(adjustments) + "." if adjustments else ""}
+    Return only a numbered list with artist and title.
+    Format as: 1. Artist - Song Title
+    """
+
+async def _completion_chunks(llm, prompt, completion_cache):
+    """Yield the AI response piece by piece, replaying it from cache if seen before."""
+    cached = completion_cache.get(prompt)
+    if cached and time.monotonic() - cached[0] < COMPLETION_CACHE_TTL:
+        yield cached[1]
+        return
+
+    response = await llm.chat.completions.create(
+        model="deepseek-reasoner",
+        messages=[
+            {"role": "system", "content": "You are a music recommendation expert."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.7,
+        stream=True
+    )
+
+    parts = []
+    async for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            yield parts[-1]
+    text = "".join(parts)
+    if not _REC_RE.search(text):
+        # Don't replay a refusal or empty answer; the next click asks again
+        return
+    completion_cache.pop(prompt, None)
+    if len(completion_cache) >= COMPLETION_CACHE_SIZE:
+        # Dicts keep insertion order, so the first key is the oldest entry
+        del completion_cache[next(iter(completion_cache))]
+    completion_cache[prompt] = (time.monotonic(), text)
+
+async def _completion_lines(llm, prompt, completion_cache):
+    """Yield each line of the AI response as soon as it is complete."""
+    buffer = ""
+    async for piece in _completion_chunks(llm, prompt, completion_cache):
+        buffer += piece
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line
+    yield buffer
+
+async def get_recommendations(llm, queue, completion_cache, song_list, sampled_from, num_songs, release_year, tempo, energy, mood):
+    prompt = _build_prompt(tuple(song_list), sampled_from, num_songs, release_year, tempo, energy, mood)
+
+    # Queue each song as soon as its line of the response completes,
+    # skipping repeats so the same song is only searched once
+    seen = set()
+    async for line in _completion_lines(llm, prompt, completion_cache):
+        for song in parse_recommendations(line):
+            key = _normalize(song)
+            if key in seen:
+                continue
+            seen.add(key)
+            await queue.put((len(seen) - 1, song))
+
+_REC_RE = re.compile(r"^\s*\d+\.\s*([^-\n]+-[^\n]+?)\s*$", re.MULTILINE)
 
 def parse_recommendations(text):
-    songs = []
-    for line in text.split('\n'):
-        if line.strip() and '. ' in line:
+    return [m.strip() for m in _REC_RE.findall(text)]
+
+def chunks(items, size):
+    """Yield successive slices of at most `size` items."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+async def _rate_limited(request, gate):
+    """Send `request()`, pausing every request sharing `gate` for Retry-After on a 429."""
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        await gate.wait()
+        r = await request()
+        if r.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+            return r
+        retry_after = float(r.headers.get("Retry-After", "1"))
+        if retry_after > MAX_RETRY_AFTER:
+            raise RuntimeError(
+                f"Spotify is rate limiting requests, try again in {int(retry_after)} seconds"
+            )
+        if gate.is_set():
+            # First request to hit the limit holds back all the others
+            gate.clear()
             try:
-                song = line.split('. ', 1)[1].strip()
-                if '-' in song:
-                    songs.append(song)
-            except:
-                continue
-    return songs
+                await asyncio.sleep(retry_after)
+            finally:
+                # Reopen even if this run is cancelled, or every session stays blocked
+                gate.set()
 
-def create_spotify_playlist(sp, song_list, playlist_name):
-    try:
-        track_ids = []
-        for song in song_list:
-            result = sp.search(q=song, type='track', limit=1)
-            if result['tracks']['items']:
-                track_ids.append(result['tracks']['items'][0]['id'])
+async def _search_track(client, gate, q):
+    """Search Spotify for a single track."""
+    r = await _rate_limited(
+        lambda: client.get("/search", params={"q": q, "type": "track", "limit": 1}),
+        gate
+    )
+    r.raise_for_status()
+    return r.json()["tracks"]["items"]
 
-        user_id = sp.me()['id']
-        playlist = sp.user_playlist_create(user=user_id, name=playlist_name, public=True)
+def _normalize(q):
+    """Cache key for a search query."""
+    return re.sub(r"\s+", " ", q.strip().lower())
 
-        if track_ids:
-            sp.playlist_add_items(playlist['id'], track_ids)
+async def _search_worker(client, gate, queue, results, id_cache, progress):
+    """Resolve queued songs to track IDs until the None sentinel arrives."""
+    while (job := await queue.get()) is not None:
+        i, song = job
+        key = _normalize(song)
+        if key not in id_cache:
+            items = await _search_track(client, gate, song)
+            id_cache[key] = items[0]['id'] if items else None
+        results[i] = id_cache[key]
+        progress["resolved"] += 1
 
-        return playlist['external_urls']['spotify']
-    except Exception as e:
-        st.error(f"Playlist creation failed: {str(e)}")
-        return None
+async def _fetch_page(client, gate, pid, offset, sem):
+    """Fetch a single page of playlist tracks."""
+    async with sem:
+        r = await _rate_limited(
+            lambda: client.get(
+                f"/playlists/{pid}/tracks",
+                params={"offset": offset, "limit": PAGE_SIZE, "fields": "items(track(name,id))"}
+            ),
+            gate
+        )
+        r.raise_for_status()
+        return r.json()["items"]
+
+async def _fetch_all_tracks(client, gate, pid, total):
+    """Fetch every page of a playlist concurrently, preserving track order."""
+    sem = asyncio.Semaphore(PAGE_CONCURRENCY)
+    pages = await asyncio.gather(
+        *[_fetch_page(client, gate, pid, o, sem) for o in range(0, total, PAGE_SIZE)]
+    )
+    return [item for page in pages for item in page]
+
+async def create_spotify_playlist(client, gate, user_id, track_ids, playlist_name):
+    r = await _rate_limited(
+        lambda: client.post(
+            f"/users/{user_id}/playlists",
+            json={"name": playlist_name, "public": True}
+        ),
+        gate
+    )
+    r.raise_for_status()
+    playlist = r.json()
+
+    for chunk in chunks(track_ids, ADD_BATCH_SIZE):
+        r = await _rate_limited(
+            lambda: client.post(
+                f"/playlists/{playlist['id']}/tracks",
+                json={"uris": [f"spotify:track:{i}" for i in chunk]}
+            ),
+            gate
+        )
+        r.raise_for_status()
+
+    return playlist['external_urls']['spotify']
+
+async def _generate(llm, gate, token, user_id, id_cache, completion_cache, progress, playlist,
+                    num_songs, release_year, tempo, energy, mood, playlist_name):
+    """Full pipeline. Returns the new playlist's URL, or None if the AI gave no songs."""
+    # One HTTP/2 connection carries every Spotify request of this run
+    async with httpx.AsyncClient(
+        base_url=SPOTIFY_API_URL,
+        http2=True,
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=10
+    ) as client:
+        tracks = await _fetch_all_tracks(client, gate, playlist['id'], playlist['tracks']['total'])
+        track_names = [t['track']['name'] for t in tracks if t.get('track')]
+        sampled_from = None
+        if len(track_names) > PROMPT_TRACK_LIMIT:
+            # Seeded by playlist so reruns send the same sample (and hit the caches)
+            sampled_from = len(track_names)
+            track_names = random.Random(playlist['id']).sample(track_names, PROMPT_TRACK_LIMIT)
+
+        # Search workers consume songs while the AI is still streaming the rest
+        queue = asyncio.Queue()
+        results = {}
+
+        async def produce():
+            await get_recommendations(
+                llm, queue, completion_cache, track_names, sampled_from,
+                num_songs, release_year, tempo, energy, mood
+            )
+            for _ in range(SEARCH_CONCURRENCY):
+                queue.put_nowait(None)
+
+        # A failed search cancels the stream and the other workers straight away
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(produce())
+                for _ in range(SEARCH_CONCURRENCY):
+                    tg.create_task(_search_worker(client, gate, queue, results, id_cache, progress))
+        except ExceptionGroup as eg:
+            raise eg.exceptions[0]
+
+        if not results:
+            return None
+
+        # Different queries can still resolve to the same track
+        track_ids = list(dict.fromkeys(results[i] for i in sorted(results) if results[i]))
+        return await create_spotify_playlist(client, gate, user_id, track_ids, playlist_name)
 
 # ======================================
 # 6. Run App